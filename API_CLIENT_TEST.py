@@ -17,6 +17,14 @@ def get_sale_details(sale_id):
     print(f"\n--- Sale Details for ID {sale_id} ---")
     print(json.dumps(response.json(), indent=2))
 
+def get_sales_details(sale_ids, response_format="json"):
+    """Fetches details for several sales in one request ('json' or 'columnar' format)."""
+    ids = ",".join(str(sale_id) for sale_id in sale_ids)
+    response = requests.get(f"{BASE_URL}/sales/details", params={"ids": ids, "format": response_format})
+    response.raise_for_status()
+    print(f"\n--- Sale Details for IDs {ids} ({response_format}) ---")
+    print(json.dumps(response.json(), indent=2))
+
 def process_new_sale(items):
     """Processes a new sale with the given items."""
     print("\n--- Processing New Sale ---")
@@ -0,0 +1,327 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from database import get_db_connection
+
+# Rows pulled from SQLite per fetchmany() call while building the column arrays.
+CHUNK_SIZE = int(os.getenv('ANALYTICS_CHUNK_SIZE', '200000'))
+
+# Histories with more line items than this are written to memory-mapped .npy
+# files under ANALYTICS_MMAP_DIR instead of being held in RAM.
+MMAP_THRESHOLD = int(os.getenv('ANALYTICS_MMAP_THRESHOLD', '5000000'))
+MMAP_DIR = os.getenv('ANALYTICS_MMAP_DIR', 'analytics_cache')
+
+# Pair counting is split across threads once a window has this many line items.
+PARALLEL_THRESHOLD = int(os.getenv('ANALYTICS_PARALLEL_THRESHOLD', '1000000'))
+WORKERS = int(os.getenv('ANALYTICS_WORKERS', os.cpu_count() or 1))
+
+# Baskets bigger than this are left out of pair counting (pairs grow quadratically).
+MAX_BASKET_SIZE = 50
+
+# How long a computed report is served from cache if no new sales arrive,
+# and how many distinct (days, top) reports are kept (least recently used go first).
+CACHE_TTL_SECONDS = 60
+CACHE_MAX_ENTRIES = 32
+
+# Upper bounds for the request parameters.
+MAX_DAYS = 3650
+MAX_TOP = 100
+
+# Requests allowed to wait for a report build in one process; more get AnalyticsBusyError.
+MAX_QUEUED_BUILDS = int(os.getenv('ANALYTICS_MAX_QUEUED_BUILDS', '4'))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Reports are built one at a time on their own thread, away from the threads
+# serving the tills; builds are CPU-bound anyway.
+_build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='analytics')
+_queued_builds = 0
+_queued_lock = threading.Lock()
+
+class AnalyticsBusyError(Exception):
+    """Raised by build_report() when MAX_QUEUED_BUILDS requests are already waiting."""
+
+def load_line_items(conn, since=None, chunk_size=CHUNK_SIZE):
+    """
+    Loads sale_items (joined with the sale date) into NumPy columns, ordered by sale.
+    Rows are read in chunks so the Python row objects never exist all at once.
+    Returns (columns, spill_dir): columns is a dict of equal-length arrays
+    (sale_id, product_id, quantity, price, sold_at as a Unix timestamp).
+    Large windows are memory-mapped from .npy files in spill_dir, a fresh
+    directory per call that the caller must delete when done (None otherwise).
+    """
+    where = "WHERE s.sale_date >= ?" if since else ""
+    params = (since,) if since else ()
+
+    # The COUNT sizes the arrays, so it and the SELECT must see the same snapshot:
+    # run both in one read transaction (WAL keeps writers going meanwhile)
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute('BEGIN')
+    try:
+        total = conn.execute(f'''
+            SELECT COUNT(*) FROM sale_items si JOIN sales s ON s.id = si.sale_id {where}
+        ''', params).fetchone()[0]
+
+        columns = {}
+        dtypes = [('sale_id', np.int64), ('product_id', np.int64), ('quantity', np.int64),
+                  ('price', np.float64), ('sold_at', np.int64)]
+        spill_dir = None
+        if total > MMAP_THRESHOLD:
+            # Per-call directory: several server processes may build reports at once
+            os.makedirs(MMAP_DIR, exist_ok=True)
+            spill_dir = tempfile.mkdtemp(prefix='build-', dir=MMAP_DIR)
+        for name, dtype in dtypes:
+            if spill_dir:
+                columns[name] = np.lib.format.open_memmap(os.path.join(spill_dir, f'{name}.npy'),
+                                                          mode='w+', dtype=dtype, shape=(total,))
+            else:
+                columns[name] = np.empty(total, dtype=dtype)
+
+        cursor = conn.cursor()
+        cursor.row_factory = None # Plain tuples are much cheaper than sqlite3.Row here
+        cursor.execute(f'''
+            SELECT si.sale_id, si.product_id, si.quantity, si.price_at_sale,
+                   CAST(strftime('%s', s.sale_date) AS INTEGER)
+            FROM sale_items si
+            JOIN sales s ON s.id = si.sale_id
+            {where}
+            ORDER BY si.sale_id
+        ''', params)
+
+        offset = 0
+        while offset < total:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            block = np.array(rows, dtype=np.float64)
+            end = offset + len(rows)
+            for i, (name, dtype) in enumerate(dtypes):
+                columns[name][offset:end] = block[:, i].astype(dtype)
+            offset = end
+        return columns, spill_dir
+    finally:
+        if own_transaction:
+            conn.rollback() # Read only; just ends the transaction
+
+def top_sellers(product_id, quantity, price, n=10):
+    """Returns (product_ids, units, revenue) for the n products with the most units sold."""
+    if len(product_id) == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.float64)
+    units = np.bincount(product_id, weights=quantity)
+    revenue = np.bincount(product_id, weights=quantity * price)
+    n = min(n, np.count_nonzero(units))
+    top = np.argpartition(-units, n - 1)[:n] if n else np.empty(0, np.int64)
+    top = top[np.argsort(-units[top], kind='stable')]
+    return top, units[top].astype(np.int64), revenue[top]
+
+def velocity(product_id, quantity, days, n=10):
+    """Returns (product_ids, units_per_day) for the n fastest-selling products over `days` days."""
+    if len(product_id) == 0:
+        return np.empty(0, np.int64), np.empty(0, np.float64)
+    per_day = np.bincount(product_id, weights=quantity) / max(days, 1)
+    n = min(n, np.count_nonzero(per_day))
+    top = np.argpartition(-per_day, n - 1)[:n] if n else np.empty(0, np.int64)
+    top = top[np.argsort(-per_day[top], kind='stable')]
+    return top, per_day[top]
+
+def _sorted_unique(keys):
+    """
+    Returns (unique_keys, counts) for an int64 key array.
+    A plain sort plus run-length step; noticeably faster than np.unique on
+    the mostly-sorted keys produced here.
+    """
+    keys = np.sort(keys)
+    if len(keys) == 0:
+        return keys, np.empty(0, np.int64)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.diff(np.r_[starts, len(keys)])
+
+def _basket_pairs(sale_id, product_id, max_basket_size, stride):
+    """
+    Emits one encoded key (a * stride + b, a < b) per pair of distinct products
+    sharing a basket. Inputs must be sorted by sale_id.
+    """
+    stride = np.int64(stride)
+    # One row per (sale, product), so a product bought twice in a sale counts once
+    keys, _ = _sorted_unique(sale_id * stride + product_id)
+    sales = keys // stride
+    products = keys % stride
+
+    starts = np.flatnonzero(np.r_[True, sales[1:] != sales[:-1]])
+    sizes = np.diff(np.r_[starts, len(sales)])
+    keep = np.repeat(sizes <= max_basket_size, sizes)
+    basket_end = np.repeat(starts + sizes, sizes)
+
+    # Row i pairs with every later row of its basket: rows i+1 .. basket_end-1
+    idx = np.flatnonzero(keep)
+    counts = basket_end[idx] - idx - 1
+    left = np.repeat(idx, counts)
+    step = np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    right = left + step
+    return products[left] * stride + products[right]
+
+def frequent_pairs(sale_id, product_id, n=10, max_basket_size=MAX_BASKET_SIZE, workers=WORKERS):
+    """
+    Returns (product_a, product_b, count) for the n product pairs that appear
+    together in the most baskets. Large windows are split at sale boundaries
+    and counted on several threads (NumPy releases the GIL while sorting).
+    """
+    empty = np.empty(0, np.int64)
+    if len(product_id) == 0:
+        return empty, empty, empty
+
+    if workers > 1 and len(sale_id) > PARALLEL_THRESHOLD:
+        bounds = np.searchsorted(sale_id, np.linspace(sale_id[0], sale_id[-1] + 1, workers + 1))
+        spans = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+        with ThreadPoolExecutor(max_workers=len(spans)) as pool:
+            parts = list(pool.map(lambda span: _count_pairs(sale_id[span[0]:span[1]], product_id[span[0]:span[1]],
+                                                            max_basket_size, product_id.max() + 1), spans))
+        keys = np.concatenate([part[0] for part in parts])
+        weights = np.concatenate([part[1] for part in parts])
+        # Spans never share a sale, but the same pair shows up in several spans
+        order = np.argsort(keys, kind='stable')
+        keys, weights = keys[order], weights[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        counts = np.add.reduceat(weights, starts) if len(keys) else weights
+        keys = keys[starts] if len(keys) else keys
+    else:
+        keys, counts = _count_pairs(sale_id, product_id, max_basket_size, product_id.max() + 1)
+
+    n = min(n, len(keys))
+    if n == 0:
+        return empty, empty, empty
+    top = np.argpartition(-counts, n - 1)[:n]
+    top = top[np.argsort(-counts[top], kind='stable')]
+    stride = np.int64(product_id.max() + 1)
+    return keys[top] // stride, keys[top] % stride, counts[top]
+
+def _count_pairs(sale_id, product_id, max_basket_size, stride):
+    """Counts encoded pair keys for one slice of line items."""
+    return _sorted_unique(_basket_pairs(sale_id, product_id, max_basket_size, stride))
+
+def _data_version(conn):
+    """Cheap fingerprint of sale_items (a primary-key lookup); changes whenever a sale is recorded."""
+    return conn.execute('SELECT MAX(id) FROM sale_items').fetchone()[0]
+
+def build_report(days=30, n=10):
+    """
+    Computes top sellers, sales velocity and frequently-bought-together pairs
+    for the last `days` days (all history if days is None), as JSON-ready dicts.
+    Results are cached until new line items arrive or CACHE_TTL_SECONDS pass.
+    Cache misses are built on the analytics thread; the caller waits for the
+    result, or gets AnalyticsBusyError if MAX_QUEUED_BUILDS callers already are.
+    """
+    global _queued_builds
+    conn = get_db_connection()
+    try:
+        key = (days, n, _data_version(conn))
+    finally:
+        conn.close()
+    report = _cached_report(key)
+    if report is not None:
+        return report
+
+    with _queued_lock:
+        if _queued_builds >= MAX_QUEUED_BUILDS:
+            raise AnalyticsBusyError("Too many analytics reports are being built, try again shortly.")
+        _queued_builds += 1
+    try:
+        return _build_executor.submit(_build_and_cache, key).result()
+    finally:
+        with _queued_lock:
+            _queued_builds -= 1
+
+def _build_and_cache(key):
+    """Runs on the analytics thread: builds the report for key unless a queued build already did."""
+    report = _cached_report(key)
+    if report is not None:
+        return report
+    days, n, _ = key
+    conn = get_db_connection()
+    try:
+        report = _compute_report(conn, days, n)
+    finally:
+        conn.close()
+    with _cache_lock:
+        _cache[(days, n)] = (key, time.monotonic(), report)
+        _cache.move_to_end((days, n))
+        while len(_cache) > CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return report
+
+def _cached_report(key):
+    """Returns the cached report for key if it is still fresh, else None."""
+    with _cache_lock:
+        cached = _cache.get(key[:2])
+        if cached and cached[0] == key and time.monotonic() - cached[1] < CACHE_TTL_SECONDS:
+            _cache.move_to_end(key[:2])
+            return cached[2]
+    return None
+
+def _compute_report(conn, days, n):
+    """Loads the window's line items and runs every metric over them."""
+    since = None
+    if days is not None:
+        since = conn.execute("SELECT datetime('now', ?)", (f'-{int(days)} days',)).fetchone()[0]
+    cols, spill_dir = load_line_items(conn, since)
+    try:
+        return _summarise(conn, cols, days, n)
+    finally:
+        del cols
+        if spill_dir:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+def _summarise(conn, cols, days, n):
+    """Runs every metric over the loaded columns and shapes the JSON report."""
+    if days is not None:
+        window_days = days
+    elif len(cols['sold_at']):
+        window_days = max((cols['sold_at'].max() - cols['sold_at'].min()) / 86400, 1)
+    else:
+        window_days = 1
+
+    top_ids, top_units, top_revenue = top_sellers(cols['product_id'], cols['quantity'], cols['price'], n)
+    fast_ids, per_day = velocity(cols['product_id'], cols['quantity'], window_days, n)
+    pair_a, pair_b, pair_counts = frequent_pairs(cols['sale_id'], cols['product_id'], n)
+
+    wanted = {int(i) for i in np.concatenate([top_ids, fast_ids, pair_a, pair_b])}
+    products = {}
+    if wanted:
+        placeholders = ','.join('?' * len(wanted))
+        for row in conn.execute(f'SELECT id, sku, name, stock_quantity FROM products WHERE id IN ({placeholders})',
+                                tuple(wanted)):
+            products[row['id']] = row
+
+    def sku(product_id):
+        row = products.get(int(product_id))
+        return row['sku'] if row else None
+
+    report = {
+        'days': days,
+        'line_items': int(len(cols['product_id'])),
+        'top_sellers': [
+            {'sku': sku(pid), 'name': products[int(pid)]['name'] if int(pid) in products else None,
+             'units': int(units), 'revenue': round(float(revenue), 2)}
+            for pid, units, revenue in zip(top_ids, top_units, top_revenue)
+        ],
+        'velocity': [
+            {'sku': sku(pid), 'units_per_day': round(float(rate), 3),
+             'days_of_cover': (round(products[int(pid)]['stock_quantity'] / float(rate), 1)
+                               if int(pid) in products else None)}
+            for pid, rate in zip(fast_ids, per_day)
+        ],
+        'bought_together': [
+            {'sku_a': sku(a), 'sku_b': sku(b), 'baskets': int(count)}
+            for a, b, count in zip(pair_a, pair_b, pair_counts)
+        ],
+    }
+    return report
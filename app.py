@@ -1,7 +1,12 @@
 import os
-from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, session, g
+from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, session, g, Response
 import sqlite3
-from database import get_db_connection, init_db
+from database import get_db_connection, init_db, write_transaction
+import analytics
+import inventory
+import fragment_cache
+import job_queue
+import time
 import json
 from werkzeug.security import generate_password_hash, check_password_hash # For password handling
 from functools import wraps # For creating decorators
@@ -11,15 +16,38 @@ from dotenv import load_dotenv
 load_dotenv()
 # --- End .env loading ---
 
+from jinja2 import FileSystemBytecodeCache
+
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'default_fallback_secret_key_for_dev_only')
 
+# Keep compiled templates on disk so new workers don't recompile them on start.
+# Optional: on a read-only install the templates are simply compiled in memory.
+JINJA_CACHE_DIR = os.getenv('JINJA_CACHE_DIR', os.path.join(app.instance_path, 'jinja_cache'))
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+except OSError as e:
+    print(f"Template bytecode cache disabled ({JINJA_CACHE_DIR}: {e})")
+
 # Initialize the database when the application starts
 with app.app_context():
     init_db()
 
 # --- Authentication and Authorization Decorators ---
 
+# Background job workers (job_queue.py) per server process; 0 if they run as a separate `python job_queue.py`
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+
+@app.before_request
+def start_job_workers():
+    """
+    Starts this process's job workers on its first request. Only processes that
+    serve requests start them, so the debug reloader's parent and a preloading
+    gunicorn master never do, whatever server launched the app.
+    """
+    job_queue.start_workers(JOB_WORKERS)
+
 @app.before_request
 def load_logged_in_user():
     """
@@ -112,12 +140,15 @@ def index():
     """
     Renders the homepage, displaying all products.
     Also includes a form to add new products.
+    The product table is cached as HTML until the catalog changes.
     """
     conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products').fetchall()
+    product_table = fragment_cache.get_or_render(
+        'product_table', fragment_cache.catalog_version(conn),
+        lambda: render_template('_product_table.html', products=conn.execute('SELECT * FROM products').fetchall()))
     conn.close()
     # Pass g.user and g.role to the template for conditional rendering
-    return render_template('index.html', products=products, user=g.user, role=g.role)
+    return render_template('index.html', product_table=product_table, user=g.user, role=g.role)
 
 @app.route('/make_sale')
 @login_required # Requires user to be logged in
@@ -125,12 +156,14 @@ def index():
 def make_sale_page():
     """
     Renders the page for making a new sale.
-    Displays available products for selection.
+    Displays available products for selection (cached as HTML until the catalog changes).
     """
     conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products').fetchall()
+    sale_products = fragment_cache.get_or_render(
+        'sale_products', fragment_cache.catalog_version(conn),
+        lambda: render_template('_sale_products.html', products=conn.execute('SELECT * FROM products').fetchall()))
     conn.close()
-    return render_template('make_sale.html', products=products, user=g.user, role=g.role)
+    return render_template('make_sale.html', sale_products=sale_products, user=g.user, role=g.role)
 
 @app.route('/sales_history')
 @login_required # Requires user to be logged in
@@ -138,11 +171,15 @@ def make_sale_page():
 def sales_history_page():
     """
     Renders the page displaying a list of all past sales.
+    The sales table is cached as HTML until a new sale is recorded.
     """
     conn = get_db_connection()
-    sales = conn.execute('SELECT id, sale_date, total_amount FROM sales ORDER BY sale_date DESC').fetchall()
+    sales_table = fragment_cache.get_or_render(
+        'sales_table', fragment_cache.sales_version(conn),
+        lambda: render_template('_sales_table.html',
+                                sales=conn.execute('SELECT id, sale_date, total_amount FROM sales ORDER BY sale_date DESC').fetchall()))
     conn.close()
-    return render_template('sales_history.html', sales=sales, user=g.user, role=g.role)
+    return render_template('sales_history.html', sales_table=sales_table, user=g.user, role=g.role)
 
 # --- Backend API Endpoints (for processing data) ---
 
@@ -152,12 +189,13 @@ def sales_history_page():
 def add_product():
     """
     API endpoint to add a new product.
-    Expected form data: sku, name, price, stock_quantity.
+    Expected form data: sku, name, price, stock_quantity, optional reorder_point.
     """
     sku = request.form['sku']
     name = request.form['name']
     price = request.form['price']
     stock_quantity = request.form['stock_quantity']
+    reorder_point = request.form.get('reorder_point') or '0'
 
     if not sku or not name or not price or not stock_quantity:
         flash('All product fields are required!', 'error')
@@ -165,49 +203,48 @@ def add_product():
     try:
         price = float(price)
         stock_quantity = int(stock_quantity)
-        if price <= 0 or stock_quantity < 0:
-            flash('Price must be positive, stock quantity non-negative.', 'error')
+        reorder_point = int(reorder_point)
+        if price <= 0 or stock_quantity < 0 or reorder_point < 0:
+            flash('Price must be positive, stock quantity and reorder point non-negative.', 'error')
             return redirect(url_for('index'))
     except ValueError:
-        flash('Invalid price or stock quantity format.', 'error')
+        flash('Invalid price, stock quantity or reorder point format.', 'error')
         return redirect(url_for('index'))
 
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO products (sku, name, price, stock_quantity) VALUES (?, ?, ?, ?)",
-                       (sku, name, price, stock_quantity))
-        conn.commit()
+        _insert_product(sku, name, price, stock_quantity, reorder_point, g.user['id'])
         flash(f'Product "{name}" added successfully!', 'success')
     except sqlite3.IntegrityError:
         flash(f'Product with SKU "{sku}" already exists. Please use a unique SKU.', 'error')
-        conn.rollback()
-    finally:
-        conn.close()
+    except job_queue.QueueFullError:
+        flash('The system is busy, please try again shortly.', 'error')
     return redirect(url_for('index'))
 
-@app.route('/process_sale', methods=['POST'])
-@login_required # Requires user to be logged in
-@role_required('cashier') # Requires cashier or manager role
-def process_sale():
+# --- Database write transactions (see database.write_transaction) ---
+
+def _insert_product(sku, name, price, stock_quantity, reorder_point, user_id=None):
+    """Adds a product. Raises sqlite3.IntegrityError if the SKU is taken."""
+    with write_transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO products (sku, name, price, stock_quantity, reorder_point) VALUES (?, ?, ?, ?, ?)",
+                       (sku, name, price, stock_quantity, reorder_point))
+        product_id = cursor.lastrowid
+        inventory.record_stock_change(cursor, product_id, sku, None, None, stock_quantity, reorder_point)
+        job_queue.enqueue(cursor, 'product_changed', {'event': 'product_added', 'product_id': product_id, 'sku': sku,
+                                                      'old_stock': None, 'new_stock': stock_quantity, 'user_id': user_id})
+
+def _record_sale(items_data, user_id=None):
     """
-    API endpoint to process a new sale.
-    This is the core transactional logic.
-    Expected JSON data: [{"product_sku": "SKU001", "quantity": 2}, ...]
+    Validates the items, decrements stock and records the sale in one transaction.
+    Receipts, stock events and the audit entry are left to a queued background job.
+    Returns (sale_id, total_amount). Raises ValueError for bad input or stock problems,
+    job_queue.QueueFullError if the background queue is full.
     """
-    try:
-        items_data = request.json
-        if not items_data:
-            flash('No items provided for sale.', 'error')
-            return jsonify({"error": "No items provided for sale"}), 400
-
-        conn = get_db_connection()
+    with write_transaction() as conn:
         cursor = conn.cursor()
         total_amount = 0
         sale_items_to_insert = []
 
-        cursor.execute("BEGIN TRANSACTION")
-
         for item in items_data:
             product_sku = item.get('product_sku')
             quantity = item.get('quantity')
@@ -215,7 +252,7 @@ def process_sale():
             if not product_sku or not isinstance(quantity, int) or quantity <= 0:
                 raise ValueError(f"Invalid item data: {item}. SKU and positive quantity required.")
 
-            product_row = cursor.execute('SELECT id, name, price, stock_quantity FROM products WHERE sku = ?', (product_sku,)).fetchone()
+            product_row = cursor.execute('SELECT id, name, price, stock_quantity, reorder_point FROM products WHERE sku = ?', (product_sku,)).fetchone()
 
             if not product_row:
                 raise ValueError(f"Product with SKU '{product_sku}' not found.")
@@ -230,6 +267,8 @@ def process_sale():
 
             new_stock = current_stock - quantity
             cursor.execute('UPDATE products SET stock_quantity = ? WHERE id = ?', (new_stock, product_id))
+            inventory.record_stock_change(cursor, product_id, product_sku, current_stock, product_row['reorder_point'],
+                                          new_stock, product_row['reorder_point'])
 
             item_total = product_price * quantity
             total_amount += item_total
@@ -246,20 +285,138 @@ def process_sale():
             cursor.execute("INSERT INTO sale_items (sale_id, product_id, quantity, price_at_sale) VALUES (?, ?, ?, ?)",
                            (sale_id, item_data['product_id'], item_data['quantity'], item_data['price_at_sale']))
 
-        conn.commit()
+        job_queue.enqueue(cursor, 'sale_completed', {'sale_id': sale_id, 'user_id': user_id})
+
+        return sale_id, total_amount
+
+def _update_product_row(sku, name, price, stock_quantity, reorder_point=None, user_id=None):
+    """
+    Updates a product by SKU (reorder_point=None keeps the current one).
+    Returns False if no product has that SKU.
+    """
+    with write_transaction() as conn:
+        cursor = conn.cursor()
+        old = cursor.execute('SELECT id, stock_quantity, reorder_point FROM products WHERE sku = ?', (sku,)).fetchone()
+        if not old:
+            return False
+        if reorder_point is None:
+            reorder_point = old['reorder_point']
+        cursor.execute("UPDATE products SET name = ?, price = ?, stock_quantity = ?, reorder_point = ? WHERE id = ?",
+                       (name, price, stock_quantity, reorder_point, old['id']))
+        inventory.record_stock_change(cursor, old['id'], sku, old['stock_quantity'], old['reorder_point'],
+                                      stock_quantity, reorder_point)
+        job_queue.enqueue(cursor, 'product_changed', {'event': 'product_updated', 'product_id': old['id'], 'sku': sku,
+                                                      'old_stock': old['stock_quantity'], 'new_stock': stock_quantity,
+                                                      'user_id': user_id})
+        return True
+
+# Upper bound on ids per /sales/details request; the ids are bound once per query, so
+# this stays under SQLite's host-parameter limit (999 before SQLite 3.32)
+MAX_BATCH_SALE_IDS = 500
+
+def _fetch_sales_details(sale_ids, columnar=False):
+    """
+    Fetches several sales and their items with one query per table (no per-item join).
+    Returns (found, missing_ids). With columnar=False, found is a list of dicts shaped
+    like /sale/<id>. With columnar=True, products are listed once and items become
+    parallel arrays that point into the product list:
+        {"products": {"sku": [...], "name": [...]},
+         "sales": {"id": [...], "sale_date": [...], "total_amount": [...], "item_offsets": [...]},
+         "items": {"product": [...], "quantity": [...], "price_at_sale": [...]}}
+    Items of sales["id"][i] are items[...][item_offsets[i]:item_offsets[i + 1]].
+    """
+    conn = get_db_connection()
+    placeholders = ','.join('?' * len(sale_ids))
+    sales = conn.execute(f'SELECT id, sale_date, total_amount FROM sales WHERE id IN ({placeholders})',
+                         sale_ids).fetchall()
+    cursor = conn.cursor()
+    cursor.row_factory = None # Plain tuples: one row object per item is what we are avoiding
+    items = cursor.execute(f'''
+        SELECT sale_id, product_id, quantity, price_at_sale
+        FROM sale_items
+        WHERE sale_id IN ({placeholders})
+        ORDER BY sale_id, id
+    ''', sale_ids).fetchall()
+    # Select the products through the same sale ids: binding one parameter per product
+    # could exceed the host-parameter limit for large baskets
+    products = {}
+    for row in conn.execute(f'''
+        SELECT id, sku, name FROM products
+        WHERE id IN (SELECT product_id FROM sale_items WHERE sale_id IN ({placeholders}))
+    ''', sale_ids):
+        products[row['id']] = (row['sku'], row['name'])
+    conn.close()
+    # Like the JOIN in /sale/<id>, items whose product row is gone are left out
+    product_ids = sorted(products)
+
+    sales_by_id = {sale['id']: sale for sale in sales}
+    ordered = [sales_by_id[sale_id] for sale_id in sale_ids if sale_id in sales_by_id]
+    missing = [sale_id for sale_id in sale_ids if sale_id not in sales_by_id]
+
+    items_by_sale = {}
+    for item in items:
+        if item[1] in products:
+            items_by_sale.setdefault(item[0], []).append(item)
+
+    if not columnar:
+        found = []
+        for sale in ordered:
+            details = dict(sale)
+            details['items'] = [
+                {'quantity': quantity, 'price_at_sale': price, 'product_name': products[product_id][1],
+                 'sku': products[product_id][0]}
+                for _, product_id, quantity, price in items_by_sale.get(sale['id'], [])
+            ]
+            found.append(details)
+        return found, missing
+
+    product_index = {product_id: i for i, product_id in enumerate(product_ids)}
+    found = {
+        'products': {'sku': [products[pid][0] for pid in product_ids], 'name': [products[pid][1] for pid in product_ids]},
+        'sales': {'id': [], 'sale_date': [], 'total_amount': [], 'item_offsets': [0]},
+        'items': {'product': [], 'quantity': [], 'price_at_sale': []},
+    }
+    sales_cols, item_cols = found['sales'], found['items']
+    for sale in ordered:
+        sales_cols['id'].append(sale['id'])
+        sale_items = items_by_sale.get(sale['id'], [])
+        sales_cols['sale_date'].append(sale['sale_date'])
+        sales_cols['total_amount'].append(sale['total_amount'])
+        item_cols['product'].extend(product_index[item[1]] for item in sale_items)
+        item_cols['quantity'].extend(item[2] for item in sale_items)
+        item_cols['price_at_sale'].extend(item[3] for item in sale_items)
+        sales_cols['item_offsets'].append(len(item_cols['quantity']))
+    return found, missing
+
+@app.route('/process_sale', methods=['POST'])
+@login_required # Requires user to be logged in
+@role_required('cashier') # Requires cashier or manager role
+def process_sale():
+    """
+    API endpoint to process a new sale.
+    This is the core transactional logic.
+    Expected JSON data: [{"product_sku": "SKU001", "quantity": 2}, ...]
+    """
+    try:
+        items_data = request.json
+        if not items_data:
+            flash('No items provided for sale.', 'error')
+            return jsonify({"error": "No items provided for sale"}), 400
+
+        sale_id, total_amount = _record_sale(items_data, g.user['id'])
+
         flash('Sale processed successfully!', 'success')
         return jsonify({"message": "Sale processed successfully", "sale_id": sale_id, "total_amount": total_amount}), 201
 
     except ValueError as e:
-        conn.rollback()
         flash(f'Sale failed: {str(e)}', 'error')
         return jsonify({"error": str(e)}), 400
+    except job_queue.QueueFullError as e:
+        flash('The system is busy, please try the sale again shortly.', 'error')
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        conn.rollback()
         flash(f'An unexpected error occurred: {str(e)}', 'error')
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
-    finally:
-        conn.close()
 
 
 @app.route('/products/<string:sku>', methods=['PUT'])
@@ -268,7 +425,8 @@ def process_sale():
 def update_product(sku):
     """
     API endpoint to update an existing product by its SKU.
-    Expected JSON data: name, price, stock_quantity (all fields are required for PUT).
+    Expected JSON data: name, price, stock_quantity (all fields are required for PUT),
+    plus an optional reorder_point.
     """
     try:
         data = request.json
@@ -278,6 +436,7 @@ def update_product(sku):
         name = data.get('name')
         price = data.get('price')
         stock_quantity = data.get('stock_quantity')
+        reorder_point = data.get('reorder_point')
 
         if not all([name, price is not None, stock_quantity is not None]):
             return jsonify({"error": "Name, price, and stock_quantity are required fields for PUT update."}), 400
@@ -285,24 +444,22 @@ def update_product(sku):
         try:
             price = float(price)
             stock_quantity = int(stock_quantity)
-            if price <= 0 or stock_quantity < 0:
-                return jsonify({"error": "Price must be positive, stock quantity non-negative."}), 400
+            if reorder_point is not None:
+                reorder_point = int(reorder_point)
+            if price <= 0 or stock_quantity < 0 or (reorder_point is not None and reorder_point < 0):
+                return jsonify({"error": "Price must be positive, stock quantity and reorder point non-negative."}), 400
         except ValueError:
-            return jsonify({"error": "Invalid price or stock quantity format."}), 400
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE products SET name = ?, price = ?, stock_quantity = ? WHERE sku = ?",
-                       (name, price, stock_quantity, sku))
+            return jsonify({"error": "Invalid price, stock quantity or reorder point format."}), 400
 
-        if cursor.rowcount == 0:
-            conn.close()
+        updated = _update_product_row(sku, name, price, stock_quantity, reorder_point, g.user['id'])
+        if not updated:
             return jsonify({"error": f"Product with SKU '{sku}' not found."}), 404
 
-        conn.commit()
-        conn.close()
         return jsonify({"message": f"Product '{sku}' updated successfully."}), 200
 
+    except job_queue.QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+
     except Exception as e:
         print(f"An unexpected error occurred during product update: {e}")
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
@@ -351,5 +508,141 @@ def get_sale_details_api(sale_id):
     return jsonify(sale_details)
 
 
+@app.route('/sales/details', methods=['GET'])
+@login_required # Requires user to be logged in
+@role_required('cashier') # Requires cashier or manager role
+def get_sales_details_api():
+    """
+    API endpoint to get details of many sales at once.
+    Query params: ids (comma-separated sale ids, up to MAX_BATCH_SALE_IDS),
+    format ('json' for a "sales" list shaped like /sale/<id>, or 'columnar' for top-level
+    "products", "sales" and "items" as described in _fetch_sales_details).
+    Unknown ids are listed under "missing".
+    """
+    response_format = request.args.get('format', 'json')
+    if response_format not in ('json', 'columnar'):
+        return jsonify({"error": "format must be 'json' or 'columnar'."}), 400
+    try:
+        sale_ids = list(dict.fromkeys(int(part) for part in request.args.get('ids', '').split(',') if part.strip()))
+    except ValueError:
+        return jsonify({"error": "ids must be a comma-separated list of integers."}), 400
+    if not sale_ids:
+        return jsonify({"error": "No sale ids provided."}), 400
+    if len(sale_ids) > MAX_BATCH_SALE_IDS:
+        return jsonify({"error": f"At most {MAX_BATCH_SALE_IDS} sale ids per request."}), 400
+
+    found, missing = _fetch_sales_details(sale_ids, response_format == 'columnar')
+    if response_format == 'columnar':
+        return jsonify({"format": response_format, **found, "missing": missing})
+    return jsonify({"format": response_format, "sales": found, "missing": missing})
+
+
+@app.route('/analytics', methods=['GET'])
+@login_required # Requires user to be logged in
+@role_required('manager') # Only managers can view sales analytics
+def get_analytics_api():
+    """
+    API endpoint for sales analytics: top sellers, sales velocity and
+    products frequently bought together.
+    Optional query params: days (window, default 30, at most analytics.MAX_DAYS, 'all' for full history),
+    top (default 10, at most analytics.MAX_TOP).
+    """
+    days = request.args.get('days', '30')
+    top = request.args.get('top', '10')
+    try:
+        days = None if days == 'all' else int(days)
+        top = int(top)
+        if (days is not None and not 0 < days <= analytics.MAX_DAYS) or not 0 < top <= analytics.MAX_TOP:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": f"days must be 1-{analytics.MAX_DAYS} or 'all', top 1-{analytics.MAX_TOP}."}), 400
+
+    try:
+        report = analytics.build_report(days, top)
+    except analytics.AnalyticsBusyError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify(report)
+
+
+@app.route('/inventory/low_stock', methods=['GET'])
+@login_required # Requires user to be logged in
+@role_required('manager') # Only managers handle reordering
+def get_low_stock_api():
+    """
+    API endpoint listing products at or below their reorder point.
+    Served from a partial index, so the cost depends on the number of
+    low-stock products rather than the size of the catalog.
+    """
+    conn = get_db_connection()
+    products = inventory.get_low_stock(conn)
+    conn.close()
+    return jsonify(products)
+
+@app.route('/inventory/low_stock/stream', methods=['GET'])
+@login_required # Requires user to be logged in
+@role_required('manager') # Only managers handle reordering
+def low_stock_stream():
+    """
+    Server-sent-events feed of products entering ('low') or leaving ('ok') the low-stock set.
+    Reconnecting clients resume from their Last-Event-ID; new clients only get new alerts.
+    At most inventory.MAX_STREAMS feeds are open per process (others get 503), and each
+    feed ends after inventory.STREAM_MAX_SECONDS so its thread is handed back.
+    Needs a threaded server (gunicorn's gthread workers); see gunicorn.conf.py.
+    """
+    if inventory.MAX_STREAMS == 0:
+        return jsonify({"error": "The low-stock feed is disabled on this server."}), 503
+    if not inventory.acquire_stream_slot():
+        return jsonify({"error": "Too many open low-stock feeds, try again shortly."}), 503, {'Retry-After': '10'}
+
+    try:
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        conn = get_db_connection()
+        try:
+            last_id = int(last_event_id) if last_event_id.isdigit() else inventory.latest_alert_id(conn)
+        finally:
+            conn.close()
+    except Exception:
+        inventory.release_stream_slot()
+        raise
+
+    def generate(last_id):
+        deadline = time.monotonic() + inventory.STREAM_MAX_SECONDS
+        # Sending the id up front means a reconnect resumes here even if no alert arrived
+        yield f'retry: 2000\nid: {last_id}\n\n'
+        while True:
+            conn = get_db_connection()
+            try:
+                alerts = inventory.get_alerts_since(conn, last_id)
+            finally:
+                conn.close()
+            for alert in alerts:
+                last_id = alert['id']
+                yield f"id: {alert['id']}\nevent: {alert['state']}\ndata: {json.dumps(alert)}\n\n"
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not alerts:
+                yield ': keep-alive\n\n'
+                time.sleep(min(inventory.ALERT_POLL_SECONDS, remaining))
+
+    response = Response(generate(last_id), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs when the stream ends or the client goes away
+    response.call_on_close(inventory.release_stream_slot)
+    return response
+
+@app.route('/jobs/metrics', methods=['GET'])
+@login_required # Requires user to be logged in
+@role_required('manager') # Only managers can view system metrics
+def get_job_metrics_api():
+    """
+    API endpoint reporting background job queue depth and processing lag.
+    """
+    conn = get_db_connection()
+    metrics = job_queue.get_metrics(conn)
+    conn.close()
+    return jsonify(metrics)
+
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -1,19 +1,51 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
 from werkzeug.security import generate_password_hash # Import for password hashing
 
 DATABASE_NAME = 'pos.db'
 
+# Held around every write transaction made by request threads (sales, product
+# adds/updates), so threads of one process queue here rather than on SQLite's
+# busy timeout. It is per process: other server processes and the background
+# job workers still wait on SQLite's own lock.
+write_lock = threading.Lock()
+
 def get_db_connection():
     """Establishes and returns a database connection."""
     conn = sqlite3.connect(DATABASE_NAME)
     conn.row_factory = sqlite3.Row
     return conn
 
+@contextmanager
+def write_transaction():
+    """
+    Yields a connection inside a BEGIN IMMEDIATE transaction, holding write_lock.
+    Commits when the block ends (also on return), rolls back if it raises.
+    IMMEDIATE takes SQLite's write lock up front, waiting out the busy timeout if
+    needed; a deferred BEGIN that reads and then writes fails at once with
+    'database is locked' when another connection commits in between.
+    """
+    with write_lock:
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
 def init_db():
     """Initializes the database with necessary tables, sample data, and users."""
     conn = get_db_connection()
     cursor = conn.cursor()
 
+    # WAL lets readers keep going while the single writer commits (persists in the db file)
+    cursor.execute('PRAGMA journal_mode=WAL')
+
     # Create products table (existing)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS products (
@@ -21,7 +53,49 @@ def init_db():
             sku TEXT UNIQUE NOT NULL,
             name TEXT NOT NULL,
             price REAL NOT NULL,
-            stock_quantity INTEGER NOT NULL
+            stock_quantity INTEGER NOT NULL,
+            reorder_point INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # Older databases predate reorder points: add the column in place
+    product_columns = [row['name'] for row in cursor.execute('PRAGMA table_info(products)')]
+    if 'reorder_point' not in product_columns:
+        cursor.execute('ALTER TABLE products ADD COLUMN reorder_point INTEGER NOT NULL DEFAULT 0')
+
+    # Partial index holding only low-stock products (must match inventory.LOW_STOCK_CONDITION)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_products_low_stock ON products (id)
+        WHERE stock_quantity <= reorder_point
+    ''')
+
+    # Catalog version counter for the rendered-HTML fragment cache, bumped by triggers
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS products_version_{event.lower()} AFTER {event} ON products
+            BEGIN
+                UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+
+    # Append-only log of products entering/leaving the low-stock set (feeds the SSE stream)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            sku TEXT NOT NULL,
+            stock_quantity INTEGER NOT NULL,
+            reorder_point INTEGER NOT NULL,
+            state TEXT NOT NULL CHECK(state IN ('low', 'ok')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES products(id)
         )
     ''')
 
@@ -47,6 +121,72 @@ def init_db():
         )
     ''')
 
+    # Indexes for sale lookups by date and for line-item scans by sale
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sales_sale_date ON sales (sale_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sale_items_sale_id ON sale_items (sale_id)')
+
+    # Background job queue (see job_queue.py); times are Unix timestamps
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ('pending', 'running', 'done', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            last_error TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after)')
+
+    # Tables filled asynchronously by the job handlers
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS receipts (
+            sale_id INTEGER PRIMARY KEY,
+            body TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sale_id) REFERENCES sales(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            sku TEXT NOT NULL,
+            change INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            reference_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES products(id)
+        )
+    ''')
+    # reference_id is the sale id for 'sale' events and the job id otherwise; the
+    # unique key lets a re-run job insert the same events again as no-ops
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_events_unique
+        ON stock_events (reason, reference_id, product_id)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER,
+            event TEXT NOT NULL,
+            entity TEXT NOT NULL,
+            entity_id INTEGER,
+            user_id INTEGER,
+            detail TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    audit_columns = [row['name'] for row in cursor.execute('PRAGMA table_info(audit_log)')]
+    if 'job_id' not in audit_columns:
+        cursor.execute('ALTER TABLE audit_log ADD COLUMN job_id INTEGER')
+    # One audit entry per job, however many times the job runs
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_audit_log_job_id ON audit_log (job_id)')
+
     # --- NEW: Create users table ---
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -0,0 +1,32 @@
+import threading
+
+from markupsafe import Markup
+
+# Rendered HTML fragments, keyed by fragment name. Only the latest version of
+# each fragment is kept; it is per process, so every worker renders once per version.
+_fragments = {}
+_lock = threading.Lock()
+
+def catalog_version(conn):
+    """Returns the products version number, bumped by triggers on every product insert/update/delete."""
+    return conn.execute('SELECT version FROM catalog_version WHERE id = 1').fetchone()[0]
+
+def sales_version(conn):
+    """Returns the newest sale id; sales are never edited, so this changes exactly when a sale is added."""
+    return conn.execute('SELECT MAX(id) FROM sales').fetchone()[0]
+
+def get_or_render(name, version, render):
+    """
+    Returns the cached HTML for fragment `name` if it was rendered at `version`,
+    otherwise calls render() (which must return a string) and caches the result.
+    The result is Markup, so templates can output it without escaping.
+    """
+    with _lock:
+        cached = _fragments.get(name)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    html = Markup(render())
+    with _lock:
+        _fragments[name] = (version, html)
+    return html
@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+
+# Production launcher config: gunicorn -c gunicorn.conf.py app:app
+
+bind = os.getenv('POS_BIND', '127.0.0.1:8000')
+
+# One process per core is plenty: each process serves many till connections
+# through its threads, and SQLite only allows one writer at a time anyway.
+workers = int(os.getenv('POS_WORKERS', multiprocessing.cpu_count()))
+worker_class = os.getenv('POS_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('POS_THREADS', '8'))
+
+# The low-stock feed (/inventory/low_stock/stream) keeps its request open for up to
+# STOCK_ALERT_STREAM_SECONDS, longer than `timeout` below. gthread workers are fine with
+# that, but the master would kill a sync worker mid-stream, so sync workers turn the feed off.
+if worker_class == 'sync':
+    os.environ['STOCK_ALERT_MAX_STREAMS'] = '0'
+
+# Load the app (and run init_db) once in the master before forking workers.
+# Job workers only start on a process's first request, so forking after this is safe.
+preload_app = True
+
+timeout = int(os.getenv('POS_TIMEOUT', '30'))
+graceful_timeout = 30
+keepalive = 5
+
+def when_ready(server):
+    """Compiles every template once in the master (preload_app) so forked workers start with them loaded."""
+    from app import app
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def worker_exit(server, worker):
+    """Lets in-flight background jobs finish before the worker goes away."""
+    import job_queue
+    job_queue.stop_workers()
@@ -0,0 +1,72 @@
+import os
+import threading
+
+# A product is "low" once its stock falls to or below its reorder point.
+# This exact expression is also the WHERE clause of the partial index
+# idx_products_low_stock (see database.init_db), so SQLite keeps the low-stock
+# set up to date on every stock write and lookups never scan the catalog.
+LOW_STOCK_CONDITION = 'stock_quantity <= reorder_point'
+
+# How often the server-sent-events feed checks for new stock alerts.
+ALERT_POLL_SECONDS = float(os.getenv('STOCK_ALERT_POLL_SECONDS', '2'))
+
+# Each open feed holds a server thread, so only a few may be open per process,
+# and each one ends after STREAM_MAX_SECONDS. The client then reconnects
+# (EventSource does this by itself) and resumes from its Last-Event-ID.
+MAX_STREAMS = int(os.getenv('STOCK_ALERT_MAX_STREAMS', '2'))
+STREAM_MAX_SECONDS = float(os.getenv('STOCK_ALERT_STREAM_SECONDS', '55'))
+
+_stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+def acquire_stream_slot():
+    """Reserves one of this process's MAX_STREAMS feed slots; returns False if none is free."""
+    return _stream_slots.acquire(blocking=False)
+
+def release_stream_slot():
+    """Gives back a slot taken with acquire_stream_slot()."""
+    _stream_slots.release()
+
+def is_low(stock_quantity, reorder_point):
+    """Python mirror of LOW_STOCK_CONDITION."""
+    return stock_quantity <= reorder_point
+
+def record_stock_change(cursor, product_id, sku, old_stock, old_reorder_point, new_stock, new_reorder_point):
+    """
+    Call after changing a product's stock or reorder point, inside the same transaction.
+    Appends a row to stock_alerts when the product enters or leaves the low-stock set.
+    Pass old_stock=None for a newly created product.
+    """
+    was_low = old_stock is not None and is_low(old_stock, old_reorder_point)
+    now_low = is_low(new_stock, new_reorder_point)
+    if was_low == now_low:
+        return
+    cursor.execute('''
+        INSERT INTO stock_alerts (product_id, sku, stock_quantity, reorder_point, state)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (product_id, sku, new_stock, new_reorder_point, 'low' if now_low else 'ok'))
+
+def get_low_stock(conn):
+    """Returns every product currently at or below its reorder point, lowest cover first."""
+    rows = conn.execute(f'''
+        SELECT sku, name, stock_quantity, reorder_point
+        FROM products INDEXED BY idx_products_low_stock
+        WHERE {LOW_STOCK_CONDITION}
+    ''').fetchall()
+    products = [dict(row) for row in rows]
+    products.sort(key=lambda p: p['stock_quantity'] - p['reorder_point'])
+    return products
+
+def get_alerts_since(conn, last_id, limit=100):
+    """Returns stock alerts with id > last_id, oldest first."""
+    rows = conn.execute('''
+        SELECT id, product_id, sku, stock_quantity, reorder_point, state, created_at
+        FROM stock_alerts
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    ''', (last_id, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+def latest_alert_id(conn):
+    """Returns the id of the newest stock alert (0 if there are none)."""
+    return conn.execute('SELECT COALESCE(MAX(id), 0) FROM stock_alerts').fetchone()[0]
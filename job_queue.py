@@ -0,0 +1,291 @@
+import json
+import os
+import threading
+import time
+
+from database import get_db_connection
+
+# Enqueueing fails with QueueFullError once this many jobs are waiting to run.
+MAX_PENDING_JOBS = int(os.getenv('JOB_QUEUE_MAX_PENDING', '10000'))
+
+# Attempts per job before it is marked failed; retries back off exponentially.
+MAX_ATTEMPTS = int(os.getenv('JOB_QUEUE_MAX_ATTEMPTS', '5'))
+RETRY_BASE_SECONDS = 2
+
+# How long an idle worker sleeps before polling for new jobs.
+POLL_SECONDS = float(os.getenv('JOB_QUEUE_POLL_SECONDS', '0.5'))
+
+# A job still 'running' after this long is assumed to belong to a dead worker
+# and is requeued. Handlers are idempotent, so a job that was in fact still
+# running elsewhere only repeats work, it never duplicates rows.
+STALE_AFTER_SECONDS = 300
+
+# Finished ('done' or 'failed') jobs are deleted after this many days.
+RETENTION_DAYS = float(os.getenv('JOB_QUEUE_RETENTION_DAYS', '7'))
+
+# How often each worker runs the stale-job sweep and the retention cleanup.
+HOUSEKEEPING_SECONDS = 60
+
+_handlers = {}
+_workers = []
+_workers_pid = None
+_workers_lock = threading.Lock()
+_stop = threading.Event()
+
+class QueueFullError(Exception):
+    """Raised by enqueue() when the backlog is at MAX_PENDING_JOBS."""
+
+def handler(kind):
+    """
+    Decorator registering func(conn, payload, job_id) as the handler for jobs of this kind.
+    A job may run more than once (retries, stale requeue), so handlers must be idempotent.
+    """
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+def enqueue(cursor, kind, payload):
+    """
+    Adds a job using the caller's cursor, so it commits or rolls back together
+    with the caller's transaction. Raises QueueFullError when the queue is full.
+    """
+    pending = _count_status(cursor, 'pending', limit=MAX_PENDING_JOBS)
+    if pending >= MAX_PENDING_JOBS:
+        raise QueueFullError(f"Job queue is full ({pending} pending jobs).")
+
+    now = time.time()
+    cursor.execute('''
+        INSERT INTO jobs (kind, payload, status, attempts, run_after, created_at)
+        VALUES (?, ?, 'pending', 0, ?, ?)
+    ''', (kind, json.dumps(payload), now, now))
+    return cursor.lastrowid
+
+def _count_status(cursor, status, limit=None):
+    """Counts jobs with a status from the (status, run_after) index alone, stopping at limit if given."""
+    if limit is None:
+        return cursor.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', (status,)).fetchone()[0]
+    return cursor.execute('''
+        SELECT COUNT(*) FROM (SELECT 1 FROM jobs WHERE status = ? LIMIT ?)
+    ''', (status, limit)).fetchone()[0]
+
+def _claim_job(conn):
+    """
+    Marks the oldest runnable job as running and returns it (or None).
+    Finding a candidate is a plain read, so idle workers never take the write
+    lock; the conditional UPDATE makes sure only one worker wins each job.
+    """
+    while True:
+        now = time.time()
+        job = conn.execute('''
+            SELECT id, kind, payload, attempts FROM jobs
+            WHERE status = 'pending' AND run_after <= ?
+            ORDER BY id
+            LIMIT 1
+        ''', (now,)).fetchone()
+        if job is None:
+            return None
+        claimed = conn.execute('''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?
+            WHERE id = ? AND status = 'pending'
+        ''', (now, job['id'])).rowcount
+        conn.commit()
+        if claimed:
+            return job
+        # Another worker claimed it first; look for the next one
+
+def run_one(conn):
+    """
+    Claims and runs a single job. The handler's writes and the 'done' mark are
+    committed together, so a failed attempt leaves nothing behind to clean up.
+    Returns False if there was nothing to run.
+    """
+    job = _claim_job(conn)
+    if job is None:
+        return False
+
+    attempts = job['attempts'] + 1
+    try:
+        func = _handlers.get(job['kind'])
+        if func is None:
+            raise ValueError(f"No handler registered for job kind '{job['kind']}'.")
+        conn.execute('BEGIN IMMEDIATE') # Handlers read before they write
+        func(conn, json.loads(job['payload']), job['id'])
+        conn.execute("UPDATE jobs SET status = 'done', finished_at = ?, last_error = NULL WHERE id = ?",
+                     (time.time(), job['id']))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        if attempts >= MAX_ATTEMPTS:
+            conn.execute("UPDATE jobs SET status = 'failed', finished_at = ?, last_error = ? WHERE id = ?",
+                         (time.time(), str(e), job['id']))
+        else:
+            conn.execute("UPDATE jobs SET status = 'pending', run_after = ?, last_error = ? WHERE id = ?",
+                         (time.time() + RETRY_BASE_SECONDS ** attempts, str(e), job['id']))
+        conn.commit()
+        print(f"Job {job['id']} ({job['kind']}) failed on attempt {attempts}: {e}")
+    return True
+
+def requeue_stale_jobs(conn):
+    """
+    Puts jobs left 'running' by a crashed worker (or a failed retry update) back in
+    the queue, or marks them failed if they have used up their attempts (a job that
+    keeps killing its worker must not be retried forever).
+    """
+    cutoff = time.time() - STALE_AFTER_SECONDS
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('''
+            UPDATE jobs SET status = 'failed', finished_at = ?, last_error = 'Worker stopped while running the job.'
+            WHERE status = 'running' AND started_at < ? AND attempts >= ?
+        ''', (time.time(), cutoff, MAX_ATTEMPTS))
+        conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running' AND started_at < ?", (cutoff,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def delete_old_jobs(conn):
+    """Deletes finished jobs older than RETENTION_DAYS (walks the (status, run_after) index)."""
+    cutoff = time.time() - RETENTION_DAYS * 86400
+    conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND run_after < ?", (cutoff,))
+    conn.commit()
+
+def _worker_loop():
+    conn = get_db_connection()
+    conn.isolation_level = None # Transactions are managed explicitly above
+    next_housekeeping = 0
+    try:
+        while not _stop.is_set():
+            try:
+                if time.monotonic() >= next_housekeeping:
+                    requeue_stale_jobs(conn)
+                    delete_old_jobs(conn)
+                    next_housekeeping = time.monotonic() + HOUSEKEEPING_SECONDS
+                if not run_one(conn):
+                    _stop.wait(POLL_SECONDS)
+            except Exception as e:
+                # e.g. 'database is locked' while claiming; try again shortly
+                print(f"Job worker error: {e}")
+                _stop.wait(POLL_SECONDS)
+    finally:
+        conn.close()
+
+def start_workers(count):
+    """
+    Starts `count` daemon worker threads, once per process: later calls in the
+    same process do nothing, while a forked child (e.g. a gunicorn worker
+    after preload) starts its own. Cheap enough to call on every request.
+    """
+    global _workers_pid
+    if count <= 0 or _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers.clear() # Threads inherited from a parent process do not exist here
+        _stop.clear()
+        for i in range(count):
+            worker = threading.Thread(target=_worker_loop, name=f'job-worker-{i}', daemon=True)
+            worker.start()
+            _workers.append(worker)
+        _workers_pid = os.getpid()
+
+def stop_workers(timeout=10):
+    """Signals the worker threads to stop and waits for their current job to finish."""
+    global _workers_pid
+    _stop.set()
+    for worker in _workers:
+        worker.join(timeout)
+    _workers.clear()
+    _workers_pid = None
+
+def get_metrics(conn):
+    """Returns queue depth and processing-lag figures for the /jobs/metrics endpoint."""
+    now = time.time()
+    # Pending jobs are capped at MAX_PENDING_JOBS, so these reads stay bounded
+    oldest_pending = conn.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'pending'").fetchone()[0]
+    recent = conn.execute('''
+        SELECT AVG(finished_at - created_at), MAX(finished_at - created_at) FROM (
+            SELECT finished_at, created_at FROM jobs WHERE status = 'done'
+            ORDER BY run_after DESC LIMIT 100
+        )
+    ''').fetchone()
+    return {
+        'pending': _count_status(conn, 'pending'),
+        'running': _count_status(conn, 'running'),
+        'failed': _count_status(conn, 'failed'),
+        'max_pending': MAX_PENDING_JOBS,
+        'oldest_pending_age_seconds': round(now - oldest_pending, 3) if oldest_pending is not None else 0,
+        'recent_avg_lag_seconds': round(recent[0], 3) if recent[0] is not None else None,
+        'recent_max_lag_seconds': round(recent[1], 3) if recent[1] is not None else None,
+        'workers_in_this_process': len(_workers) if _workers_pid == os.getpid() else 0,
+    }
+
+# --- Job handlers ---
+
+def _audit(conn, job_id, event, entity, entity_id, user_id, detail):
+    """Writes one audit entry per job (audit_log.job_id is unique, so reruns are no-ops)."""
+    conn.execute('''
+        INSERT OR IGNORE INTO audit_log (job_id, event, entity, entity_id, user_id, detail)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (job_id, event, entity, entity_id, user_id, json.dumps(detail) if detail is not None else None))
+
+@handler('sale_completed')
+def handle_sale_completed(conn, payload, job_id):
+    """Builds the receipt, the per-item stock-change events and the audit entry for a sale."""
+    sale_id = payload['sale_id']
+    sale = conn.execute('SELECT id, sale_date, total_amount FROM sales WHERE id = ?', (sale_id,)).fetchone()
+    if not sale:
+        raise ValueError(f"Sale {sale_id} not found.")
+    items = conn.execute('''
+        SELECT si.product_id, si.quantity, si.price_at_sale, p.name, p.sku
+        FROM sale_items si
+        JOIN products p ON si.product_id = p.id
+        WHERE si.sale_id = ?
+    ''', (sale_id,)).fetchall()
+
+    lines = [f"Sale #{sale['id']}  {sale['sale_date']}", '-' * 40]
+    for item in items:
+        lines.append(f"{item['quantity']:>3} x {item['name'][:22]:<22} {item['price_at_sale'] * item['quantity']:>10.2f}")
+    lines += ['-' * 40, f"{'TOTAL':<28} {sale['total_amount']:>10.2f}"]
+    conn.execute('INSERT OR REPLACE INTO receipts (sale_id, body) VALUES (?, ?)', (sale_id, '\n'.join(lines)))
+
+    # One event per product (a basket can list a SKU twice); unique on (reason, reference_id, product_id)
+    changes = {}
+    for item in items:
+        sku, change = changes.get(item['product_id'], (item['sku'], 0))
+        changes[item['product_id']] = (sku, change - item['quantity'])
+    for product_id, (sku, change) in changes.items():
+        conn.execute('''
+            INSERT OR IGNORE INTO stock_events (product_id, sku, change, reason, reference_id)
+            VALUES (?, ?, ?, 'sale', ?)
+        ''', (product_id, sku, change, sale_id))
+
+    _audit(conn, job_id, 'sale_completed', 'sale', sale_id, payload.get('user_id'),
+           {'total_amount': sale['total_amount'], 'items': len(items)})
+
+@handler('product_changed')
+def handle_product_changed(conn, payload, job_id):
+    """
+    Records the stock-change event (if stock moved) and the audit entry for a product add/update.
+    The event's reference_id is the job id, which makes reruns no-ops.
+    """
+    old_stock = payload.get('old_stock') or 0
+    change = payload['new_stock'] - old_stock
+    if change:
+        conn.execute('''
+            INSERT OR IGNORE INTO stock_events (product_id, sku, change, reason, reference_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (payload['product_id'], payload['sku'], change, payload['event'], job_id))
+    _audit(conn, job_id, payload['event'], 'product', payload['product_id'], payload.get('user_id'),
+           {'sku': payload['sku'], 'old_stock': payload.get('old_stock'), 'new_stock': payload['new_stock']})
+
+if __name__ == '__main__':
+    # Run the workers as a standalone process: python job_queue.py
+    start_workers(int(os.getenv('JOB_WORKERS', '2')))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_workers()
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Points the app's database at a fresh, initialised SQLite file."""
+    path = str(tmp_path / 'pos.db')
+    monkeypatch.setattr(database, 'DATABASE_NAME', path)
+    database.init_db()
+    return path
+
+
+@pytest.fixture
+def app_module(db_path, tmp_path_factory, monkeypatch):
+    """The app module, using the test database; requests do not start job workers."""
+    monkeypatch.setenv('JINJA_CACHE_DIR', str(tmp_path_factory.getbasetemp() / 'jinja_cache'))
+    import app
+    monkeypatch.setattr(app, 'JOB_WORKERS', 0)
+    return app
+
+
+def logged_in_client(app_module, username):
+    """Returns a Flask test client with `username` (a sample user from init_db) logged in."""
+    conn = database.get_db_connection()
+    user_id = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()[0]
+    conn.close()
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    return client
+
+
+@pytest.fixture
+def manager(app_module):
+    return logged_in_client(app_module, 'manager')
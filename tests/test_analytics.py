@@ -0,0 +1,171 @@
+import itertools
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import analytics
+from database import get_db_connection
+
+
+def brute_force_pairs(sale_id, product_id, max_basket_size):
+    baskets = {}
+    for sale, product in zip(sale_id.tolist(), product_id.tolist()):
+        baskets.setdefault(sale, set()).add(product)
+    counts = Counter()
+    for products in baskets.values():
+        if len(products) <= max_basket_size:
+            counts.update(itertools.combinations(sorted(products), 2))
+    return counts
+
+
+def pairs_as_counter(result):
+    return Counter({(int(a), int(b)): int(c) for a, b, c in zip(*result)})
+
+
+def random_line_items(seed, n=20000, sales=3000, products=40):
+    rng = np.random.default_rng(seed)
+    sale_id = np.sort(rng.integers(1, sales, n))
+    product_id = rng.integers(1, products, n)
+    return sale_id, product_id
+
+
+def test_basket_pairs_expands_each_basket_once():
+    # Basket 1: products 3, 5, 7 (5 bought twice); basket 2: a single product
+    sale_id = np.array([1, 1, 1, 1, 2])
+    product_id = np.array([5, 3, 7, 5, 3])
+    keys = analytics._basket_pairs(sale_id, product_id, max_basket_size=50, stride=8)
+    assert sorted((k // 8, k % 8) for k in keys.tolist()) == [(3, 5), (3, 7), (5, 7)]
+
+
+def test_basket_pairs_skips_oversized_baskets():
+    sale_id = np.array([1, 1, 1, 2, 2])
+    product_id = np.array([1, 2, 3, 1, 2])
+    keys = analytics._basket_pairs(sale_id, product_id, max_basket_size=2, stride=4)
+    assert keys.tolist() == [1 * 4 + 2]
+
+
+def test_frequent_pairs_matches_brute_force():
+    sale_id, product_id = random_line_items(seed=1)
+    n = 10_000 # Large enough to return every pair
+    result = analytics.frequent_pairs(sale_id, product_id, n=n, workers=1)
+    assert pairs_as_counter(result) == brute_force_pairs(sale_id, product_id, analytics.MAX_BASKET_SIZE)
+
+
+def test_frequent_pairs_parallel_merge_matches_serial(monkeypatch):
+    sale_id, product_id = random_line_items(seed=2)
+    serial = pairs_as_counter(analytics.frequent_pairs(sale_id, product_id, n=10_000, workers=1))
+    monkeypatch.setattr(analytics, 'PARALLEL_THRESHOLD', 0)
+    parallel = pairs_as_counter(analytics.frequent_pairs(sale_id, product_id, n=10_000, workers=4))
+    assert parallel == serial
+
+
+def test_frequent_pairs_top_n_is_sorted_by_count():
+    sale_id, product_id = random_line_items(seed=3)
+    _, _, counts = analytics.frequent_pairs(sale_id, product_id, n=5, workers=1)
+    expected = sorted(brute_force_pairs(sale_id, product_id, analytics.MAX_BASKET_SIZE).values(), reverse=True)[:5]
+    assert counts.tolist() == expected
+
+
+def test_top_sellers_and_velocity():
+    product_id = np.array([1, 2, 2, 3])
+    quantity = np.array([5, 1, 2, 1])
+    price = np.array([1.0, 2.0, 2.0, 10.0])
+    ids, units, revenue = analytics.top_sellers(product_id, quantity, price, n=2)
+    assert ids.tolist() == [1, 2]
+    assert units.tolist() == [5, 3]
+    assert revenue.tolist() == [5.0, 6.0]
+
+    ids, per_day = analytics.velocity(product_id, quantity, days=2, n=1)
+    assert ids.tolist() == [1]
+    assert per_day.tolist() == [2.5]
+
+
+def test_empty_inputs():
+    empty = np.empty(0, np.int64)
+    assert all(len(part) == 0 for part in analytics.frequent_pairs(empty, empty))
+    assert all(len(part) == 0 for part in analytics.top_sellers(empty, empty, empty.astype(float)))
+
+
+def insert_sale(conn, items):
+    cursor = conn.execute('INSERT INTO sales (total_amount) VALUES (0)')
+    for product_id, quantity in items:
+        conn.execute('INSERT INTO sale_items (sale_id, product_id, quantity, price_at_sale) VALUES (?, ?, ?, 1.0)',
+                     (cursor.lastrowid, product_id, quantity))
+    conn.commit()
+
+
+def test_load_line_items_spills_to_a_private_directory(db_path, tmp_path, monkeypatch):
+    conn = get_db_connection()
+    insert_sale(conn, [(1, 2), (2, 1)])
+    monkeypatch.setattr(analytics, 'MMAP_THRESHOLD', 0)
+    monkeypatch.setattr(analytics, 'MMAP_DIR', str(tmp_path / 'mmap'))
+
+    first, first_dir = analytics.load_line_items(conn)
+    second, second_dir = analytics.load_line_items(conn)
+    conn.close()
+    assert first_dir != second_dir
+    assert isinstance(first['sale_id'], np.memmap)
+    assert first['quantity'].tolist() == [2, 1]
+
+
+class SaleAfterCount:
+    """Connection wrapper that commits a sale from a second connection right after the COUNT runs."""
+
+    def __init__(self, conn, other):
+        self.conn, self.other = conn, other
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def execute(self, sql, *args):
+        result = self.conn.execute(sql, *args)
+        if 'COUNT(*)' in sql:
+            insert_sale(self.other, [(3, 1)])
+        return result
+
+
+def test_load_line_items_ignores_sales_committed_while_loading(db_path):
+    conn, other = get_db_connection(), get_db_connection()
+    insert_sale(conn, [(1, 2), (2, 1)])
+
+    cols, _ = analytics.load_line_items(SaleAfterCount(conn, other))
+    assert cols['product_id'].tolist() == [1, 2]
+    assert not conn.in_transaction
+    # The next load sees the new sale
+    assert analytics.load_line_items(conn)[0]['product_id'].tolist() == [1, 2, 3]
+    conn.close()
+    other.close()
+
+
+def test_build_report_cleans_up_and_caches(db_path, tmp_path, monkeypatch):
+    conn = get_db_connection()
+    insert_sale(conn, [(1, 2), (2, 1)])
+    insert_sale(conn, [(1, 1), (2, 1), (3, 1)])
+    conn.close()
+    monkeypatch.setattr(analytics, 'MMAP_THRESHOLD', 0)
+    monkeypatch.setattr(analytics, 'MMAP_DIR', str(tmp_path / 'mmap'))
+    monkeypatch.setattr(analytics, '_cache', analytics.OrderedDict())
+
+    report = analytics.build_report(days=None, n=3)
+    assert report['line_items'] == 5
+    assert report['top_sellers'][0] == {'sku': 'SKU001', 'name': 'Apple (kg)', 'units': 3, 'revenue': 3.0}
+    assert report['bought_together'][0] == {'sku_a': 'SKU001', 'sku_b': 'SKU002', 'baskets': 2}
+    assert os.listdir(tmp_path / 'mmap') == []
+    assert analytics.build_report(days=None, n=3) is report
+
+
+def test_report_cache_is_bounded(db_path, monkeypatch):
+    monkeypatch.setattr(analytics, '_cache', analytics.OrderedDict())
+    monkeypatch.setattr(analytics, 'CACHE_MAX_ENTRIES', 3)
+    for top in range(1, 6):
+        analytics.build_report(days=30, n=top)
+    assert list(analytics._cache) == [(30, 3), (30, 4), (30, 5)]
+
+
+def test_build_report_refuses_when_too_many_builds_wait(db_path, monkeypatch):
+    monkeypatch.setattr(analytics, '_cache', analytics.OrderedDict())
+    monkeypatch.setattr(analytics, 'MAX_QUEUED_BUILDS', 0)
+    with pytest.raises(analytics.AnalyticsBusyError):
+        analytics.build_report(days=30, n=10)
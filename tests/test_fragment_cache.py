@@ -0,0 +1,54 @@
+import pytest
+
+import database
+import fragment_cache
+
+
+@pytest.fixture
+def queries(app_module, monkeypatch):
+    """Records every SQL statement the views run; starts with an empty fragment cache."""
+    monkeypatch.setattr(fragment_cache, '_fragments', {})
+    statements = []
+
+    def traced_connection():
+        conn = database.get_db_connection()
+        conn.set_trace_callback(statements.append)
+        return conn
+    monkeypatch.setattr(app_module, 'get_db_connection', traced_connection)
+    return statements
+
+
+def product_queries(statements):
+    return [sql for sql in statements if sql == 'SELECT * FROM products']
+
+
+def sales_queries(statements):
+    return [sql for sql in statements if sql.startswith('SELECT id, sale_date, total_amount FROM sales')]
+
+
+def test_second_request_is_served_from_cache(manager, queries):
+    first = manager.get('/').get_data(as_text=True)
+    assert len(product_queries(queries)) == 1
+    second = manager.get('/').get_data(as_text=True)
+    assert len(product_queries(queries)) == 1
+    assert second == first
+
+
+def test_product_update_invalidates_the_catalog(manager, queries):
+    manager.get('/')
+    manager.put('/products/SKU001', json={'name': 'Green apple (kg)', 'price': 2.5, 'stock_quantity': 50})
+    page = manager.get('/').get_data(as_text=True)
+    assert len(product_queries(queries)) == 2
+    assert 'Green apple (kg)' in page
+
+
+def test_sale_invalidates_the_catalog_and_the_sales_table(manager, queries):
+    manager.get('/make_sale')
+    manager.get('/sales_history')
+    sale_id = manager.post('/process_sale', json=[{'product_sku': 'SKU001', 'quantity': 1}]).get_json()['sale_id']
+
+    manager.get('/make_sale') # Stock changed
+    history = manager.get('/sales_history').get_data(as_text=True)
+    assert len(product_queries(queries)) == 2
+    assert len(sales_queries(queries)) == 2
+    assert f'<td>{sale_id}</td>' in history
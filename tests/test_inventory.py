@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+import inventory
+from database import get_db_connection
+
+
+def alerts():
+    conn = get_db_connection()
+    rows = conn.execute('SELECT sku, stock_quantity, reorder_point, state FROM stock_alerts ORDER BY id').fetchall()
+    conn.close()
+    return [tuple(row) for row in rows]
+
+
+def update(client, sku, stock_quantity, reorder_point=None):
+    data = {'name': 'Apple (kg)', 'price': 2.5, 'stock_quantity': stock_quantity}
+    if reorder_point is not None:
+        data['reorder_point'] = reorder_point
+    assert client.put(f'/products/{sku}', json=data).status_code == 200
+
+
+def low_skus(client):
+    return [product['sku'] for product in client.get('/inventory/low_stock').get_json()]
+
+
+def test_sale_enters_and_restock_leaves_the_low_stock_set(manager):
+    update(manager, 'SKU001', 50, reorder_point=48)
+    assert alerts() == [] and low_skus(manager) == []
+
+    manager.post('/process_sale', json=[{'product_sku': 'SKU001', 'quantity': 1}])
+    assert alerts() == [] # 49 > 48
+    manager.post('/process_sale', json=[{'product_sku': 'SKU001', 'quantity': 1}])
+    assert alerts() == [('SKU001', 48, 48, 'low')]
+    assert low_skus(manager) == ['SKU001']
+
+    update(manager, 'SKU001', 100)
+    assert alerts()[1:] == [('SKU001', 100, 48, 'ok')]
+    assert low_skus(manager) == []
+
+
+def test_reorder_point_only_update_moves_a_product_in_and_out(manager):
+    update(manager, 'SKU001', 50, reorder_point=50)
+    update(manager, 'SKU001', 50, reorder_point=10)
+    assert alerts() == [('SKU001', 50, 50, 'low'), ('SKU001', 50, 10, 'ok')]
+
+
+def test_adding_a_product_at_its_reorder_point_alerts(manager):
+    form = {'sku': 'NEW1', 'name': 'New', 'price': '1.0', 'stock_quantity': '3', 'reorder_point': '5'}
+    manager.post('/products', data=form)
+    manager.post('/products', data={**form, 'sku': 'NEW2', 'stock_quantity': '30'})
+    assert alerts() == [('NEW1', 3, 5, 'low')]
+    assert low_skus(manager) == ['NEW1']
+
+
+def test_low_stock_query_uses_the_partial_index(db_path):
+    conn = get_db_connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    inventory.get_low_stock(conn)
+    conn.set_trace_callback(None)
+
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + statements[-1]).fetchall()
+    conn.close()
+    assert [row['detail'] for row in plan] == ['SCAN products USING INDEX idx_products_low_stock']
+
+
+@pytest.fixture
+def one_stream_slot(monkeypatch):
+    monkeypatch.setattr(inventory, '_stream_slots', threading.BoundedSemaphore(1))
+
+
+def test_stream_slots_are_limited_and_released(manager, one_stream_slot):
+    first = manager.get('/inventory/low_stock/stream', buffered=False)
+    assert first.status_code == 200
+    assert next(first.response) == b'retry: 2000\nid: 0\n\n'
+
+    busy = manager.get('/inventory/low_stock/stream', buffered=False)
+    assert busy.status_code == 503 and busy.headers['Retry-After'] == '10'
+
+    first.close() # Client went away
+    second = manager.get('/inventory/low_stock/stream', buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+
+def test_stream_ends_on_its_deadline_and_resumes_from_last_event_id(manager, one_stream_slot, monkeypatch):
+    monkeypatch.setattr(inventory, 'STREAM_MAX_SECONDS', 0)
+    update(manager, 'SKU001', 50, reorder_point=50)
+
+    response = manager.get('/inventory/low_stock/stream', headers={'Last-Event-ID': '0'})
+    body = response.get_data(as_text=True)
+    assert body.startswith('retry: 2000\nid: 0\n\n')
+    assert 'event: low' in body
+    response.close() # As the server does once the body is sent
+    # The finished stream gave its slot back
+    again = manager.get('/inventory/low_stock/stream', buffered=False)
+    assert again.status_code == 200
+    again.close()
+
+
+def test_stream_is_refused_when_disabled(manager, monkeypatch):
+    monkeypatch.setattr(inventory, 'MAX_STREAMS', 0)
+    assert manager.get('/inventory/low_stock/stream').status_code == 503
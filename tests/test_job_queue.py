@@ -0,0 +1,175 @@
+import os
+import time
+
+import pytest
+
+import job_queue
+from database import get_db_connection
+
+calls = []
+
+
+@job_queue.handler('test_flaky')
+def flaky_handler(conn, payload, job_id):
+    calls.append(job_id)
+    conn.execute("INSERT INTO audit_log (job_id, event, entity) VALUES (?, 'flaky', 'test')", (job_id,))
+    if len(calls) <= payload['fail_times']:
+        raise RuntimeError('boom')
+
+
+@pytest.fixture
+def conn(db_path):
+    calls.clear()
+    conn = get_db_connection()
+    conn.isolation_level = None # run_one() manages its own transactions
+    yield conn
+    conn.close()
+
+
+def enqueue(conn, kind, payload):
+    return job_queue.enqueue(conn.cursor(), kind, payload)
+
+
+def job(conn, job_id):
+    return conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+
+def make_runnable(conn, job_id):
+    conn.execute('UPDATE jobs SET run_after = 0 WHERE id = ?', (job_id,))
+
+
+def test_enqueue_refuses_when_queue_is_full(conn, monkeypatch):
+    monkeypatch.setattr(job_queue, 'MAX_PENDING_JOBS', 2)
+    enqueue(conn, 'test_flaky', {'fail_times': 0})
+    enqueue(conn, 'test_flaky', {'fail_times': 0})
+    with pytest.raises(job_queue.QueueFullError):
+        enqueue(conn, 'test_flaky', {'fail_times': 0})
+
+
+def test_failed_attempt_is_rolled_back_and_retried_with_backoff(conn):
+    job_id = enqueue(conn, 'test_flaky', {'fail_times': 1})
+
+    before = time.time()
+    assert job_queue.run_one(conn)
+    row = job(conn, job_id)
+    assert (row['status'], row['attempts'], row['last_error']) == ('pending', 1, 'boom')
+    assert row['run_after'] >= before + job_queue.RETRY_BASE_SECONDS
+    # The handler's write from the failed attempt was rolled back
+    assert conn.execute('SELECT COUNT(*) FROM audit_log').fetchone()[0] == 0
+    # Not runnable again until the backoff has passed
+    assert not job_queue.run_one(conn)
+
+    make_runnable(conn, job_id)
+    assert job_queue.run_one(conn)
+    row = job(conn, job_id)
+    assert (row['status'], row['attempts'], row['last_error']) == ('done', 2, None)
+    assert conn.execute('SELECT COUNT(*) FROM audit_log').fetchone()[0] == 1
+
+
+def test_job_fails_after_max_attempts(conn, monkeypatch):
+    monkeypatch.setattr(job_queue, 'MAX_ATTEMPTS', 3)
+    job_id = enqueue(conn, 'test_flaky', {'fail_times': 99})
+    for _ in range(3):
+        make_runnable(conn, job_id)
+        assert job_queue.run_one(conn)
+    row = job(conn, job_id)
+    assert (row['status'], row['attempts']) == ('failed', 3)
+    assert row['finished_at'] is not None
+
+
+def test_unknown_kind_is_retried_then_failed(conn, monkeypatch):
+    monkeypatch.setattr(job_queue, 'MAX_ATTEMPTS', 1)
+    job_id = enqueue(conn, 'no_such_kind', {})
+    assert job_queue.run_one(conn)
+    assert job(conn, job_id)['status'] == 'failed'
+
+
+def record_sale(conn, items):
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+    cursor.execute('INSERT INTO sales (total_amount) VALUES (0)')
+    sale_id = cursor.lastrowid
+    for product_id, quantity in items:
+        cursor.execute('INSERT INTO sale_items (sale_id, product_id, quantity, price_at_sale) VALUES (?, ?, ?, 1.0)',
+                       (sale_id, product_id, quantity))
+    job_id = job_queue.enqueue(cursor, 'sale_completed', {'sale_id': sale_id, 'user_id': 1})
+    cursor.execute('COMMIT')
+    return sale_id, job_id
+
+
+def test_sale_completed_is_idempotent(conn):
+    # The same SKU twice in one basket becomes a single stock event
+    sale_id, job_id = record_sale(conn, [(1, 2), (2, 1), (1, 3)])
+    assert job_queue.run_one(conn)
+    # Simulate a stale requeue of a job that had in fact finished
+    conn.execute("UPDATE jobs SET status = 'pending' WHERE id = ?", (job_id,))
+    assert job_queue.run_one(conn)
+
+    events = conn.execute('SELECT product_id, change FROM stock_events ORDER BY product_id').fetchall()
+    assert [tuple(e) for e in events] == [(1, -5), (2, -1)]
+    assert conn.execute('SELECT COUNT(*) FROM audit_log WHERE job_id = ?', (job_id,)).fetchone()[0] == 1
+    assert conn.execute('SELECT COUNT(*) FROM receipts WHERE sale_id = ?', (sale_id,)).fetchone()[0] == 1
+
+
+def test_housekeeping_requeues_stale_and_deletes_old_jobs(conn):
+    stale = enqueue(conn, 'test_flaky', {'fail_times': 0})
+    old = enqueue(conn, 'test_flaky', {'fail_times': 0})
+    recent = enqueue(conn, 'test_flaky', {'fail_times': 0})
+    conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                 (time.time() - job_queue.STALE_AFTER_SECONDS - 1, stale))
+    conn.execute("UPDATE jobs SET status = 'done', run_after = ? WHERE id = ?",
+                 (time.time() - job_queue.RETENTION_DAYS * 86400 - 1, old))
+    conn.execute("UPDATE jobs SET status = 'done' WHERE id = ?", (recent,))
+
+    job_queue.requeue_stale_jobs(conn)
+    job_queue.delete_old_jobs(conn)
+    assert job(conn, stale)['status'] == 'pending'
+    assert job(conn, old) is None
+    assert job(conn, recent)['status'] == 'done'
+
+
+def test_stale_job_out_of_attempts_is_failed(conn):
+    job_id = enqueue(conn, 'test_flaky', {'fail_times': 0})
+    conn.execute("UPDATE jobs SET status = 'running', attempts = ?, started_at = ? WHERE id = ?",
+                 (job_queue.MAX_ATTEMPTS, time.time() - job_queue.STALE_AFTER_SECONDS - 1, job_id))
+
+    job_queue.requeue_stale_jobs(conn)
+    assert job(conn, job_id)['status'] == 'failed'
+
+
+def test_claim_is_exclusive_and_idle_polls_take_no_write_lock(conn, db_path):
+    other = get_db_connection()
+    other.isolation_level = None
+    try:
+        # Another connection holds the write lock: an idle poll must still return straight away
+        other.execute('BEGIN IMMEDIATE')
+        assert job_queue._claim_job(conn) is None
+        other.execute('ROLLBACK')
+
+        job_id = enqueue(conn, 'test_flaky', {'fail_times': 0})
+        assert job_queue._claim_job(conn)['id'] == job_id
+        assert job_queue._claim_job(other) is None
+        assert (job(conn, job_id)['status'], job(conn, job_id)['attempts']) == ('running', 1)
+    finally:
+        other.close()
+
+
+def test_metrics(conn):
+    enqueue(conn, 'test_flaky', {'fail_times': 0})
+    job_id = enqueue(conn, 'test_flaky', {'fail_times': 0})
+    assert job_queue.run_one(conn)
+    metrics = job_queue.get_metrics(conn)
+    assert (metrics['pending'], metrics['running'], metrics['failed']) == (1, 0, 0)
+    assert metrics['recent_avg_lag_seconds'] is not None
+    assert job(conn, job_id)['status'] == 'pending'
+
+
+def test_start_workers_once_per_process(db_path):
+    try:
+        job_queue.start_workers(2)
+        first = list(job_queue._workers)
+        job_queue.start_workers(2)
+        assert job_queue._workers == first
+        assert len(first) == 2 and job_queue._workers_pid == os.getpid()
+    finally:
+        job_queue.stop_workers()
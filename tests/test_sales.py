@@ -0,0 +1,36 @@
+import threading
+
+import job_queue
+from database import get_db_connection
+
+
+def test_concurrent_sales_while_job_workers_run(db_path, manager, monkeypatch):
+    monkeypatch.setattr(job_queue, 'POLL_SECONDS', 0.01)
+    conn = get_db_connection()
+    conn.execute('UPDATE products SET stock_quantity = 100000')
+    conn.commit()
+
+    statuses = []
+
+    def sell(count):
+        for _ in range(count):
+            response = manager.post('/process_sale', json=[{'product_sku': 'SKU001', 'quantity': 1},
+                                                           {'product_sku': 'SKU002', 'quantity': 2}])
+            statuses.append(response.status_code)
+
+    job_queue.start_workers(2)
+    try:
+        threads = [threading.Thread(target=sell, args=(150,)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        job_queue.stop_workers()
+
+    assert statuses == [201] * 300
+    stock = dict(conn.execute("SELECT sku, stock_quantity FROM products WHERE sku IN ('SKU001', 'SKU002')"))
+    assert stock == {'SKU001': 100000 - 300, 'SKU002': 100000 - 600}
+    # No job attempt failed on the lock either
+    assert conn.execute('SELECT COUNT(*) FROM jobs WHERE last_error IS NOT NULL').fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,80 @@
+import sqlite3
+
+import pytest
+
+import database
+from database import get_db_connection
+
+
+@pytest.fixture
+def sales(manager):
+    """Two sales: #1 with SKU001 x2, #2 with SKU001 x1 and SKU003 x2."""
+    ids = []
+    for items in ([('SKU001', 2)], [('SKU001', 1), ('SKU003', 2)]):
+        response = manager.post('/process_sale', json=[{'product_sku': sku, 'quantity': qty} for sku, qty in items])
+        ids.append(response.get_json()['sale_id'])
+    return ids
+
+
+def test_json_format_matches_single_sale_endpoint(manager, sales):
+    body = manager.get(f'/sales/details?ids={sales[1]},999,{sales[0]}').get_json()
+    assert body['format'] == 'json'
+    assert body['missing'] == [999]
+    assert [sale['id'] for sale in body['sales']] == [sales[1], sales[0]]
+    for sale in body['sales']:
+        assert sale == manager.get(f"/sale/{sale['id']}").get_json()
+
+
+def test_columnar_format(manager, sales):
+    body = manager.get(f'/sales/details?ids={sales[0]},{sales[1]},{sales[0]}&format=columnar').get_json()
+    assert body['products'] == {'sku': ['SKU001', 'SKU003'], 'name': ['Apple (kg)', 'Bread']}
+    assert body['sales']['id'] == sales
+    assert body['sales']['total_amount'] == [5.0, 8.5]
+    assert body['sales']['item_offsets'] == [0, 1, 3]
+    assert body['items'] == {'product': [0, 0, 1], 'quantity': [2, 1, 2], 'price_at_sale': [2.5, 2.5, 3.0]}
+    assert body['missing'] == []
+
+
+def test_items_of_deleted_products_are_left_out(manager, sales):
+    conn = get_db_connection()
+    conn.execute("DELETE FROM products WHERE sku = 'SKU003'")
+    conn.commit()
+    conn.close()
+
+    body = manager.get(f'/sales/details?ids={sales[1]}').get_json()
+    assert [item['sku'] for item in body['sales'][0]['items']] == ['SKU001']
+    body = manager.get(f'/sales/details?ids={sales[1]}&format=columnar').get_json()
+    assert body['products']['sku'] == ['SKU001']
+    assert body['sales']['item_offsets'] == [0, 1]
+
+
+def test_large_baskets_stay_within_the_parameter_limit(app_module, manager, monkeypatch):
+    conn = get_db_connection()
+    conn.executemany('INSERT INTO products (sku, name, price, stock_quantity) VALUES (?, ?, 1.0, 10)',
+                     [(f'BULK{i}', f'Bulk {i}') for i in range(1200)])
+    sale_id = conn.execute('INSERT INTO sales (total_amount) VALUES (1200)').lastrowid
+    conn.execute('''
+        INSERT INTO sale_items (sale_id, product_id, quantity, price_at_sale)
+        SELECT ?, id, 1, 1.0 FROM products WHERE sku LIKE 'BULK%'
+    ''', (sale_id,))
+    conn.commit()
+    conn.close()
+
+    def limited_connection():
+        # The limit of SQLite builds before 3.32
+        conn = database.get_db_connection()
+        conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        return conn
+    monkeypatch.setattr(app_module, 'get_db_connection', limited_connection)
+
+    body = manager.get(f'/sales/details?ids={sale_id}&format=columnar').get_json()
+    assert len(body['products']['sku']) == 1200
+    assert body['sales']['item_offsets'] == [0, 1200]
+
+
+@pytest.mark.parametrize('query', ['', 'ids=', 'ids=1,x', 'ids=1&format=xml',
+                                   'ids=' + ','.join(str(i) for i in range(1, 502))])
+def test_bad_requests(manager, query):
+    response = manager.get(f'/sales/details?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()